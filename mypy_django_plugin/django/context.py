@@ -1,9 +1,10 @@
+import hashlib
 import os
 import sys
 from collections import defaultdict
 from contextlib import contextmanager
 from typing import (
-    TYPE_CHECKING, Dict, Iterable, Iterator, Optional, Set, Tuple, Type, Union,
+    TYPE_CHECKING, Dict, Iterable, Iterator, List, Optional, Set, Tuple, Type, Union,
 )
 
 from django.core.exceptions import FieldError
@@ -89,6 +90,8 @@ class DjangoContext:
         self.apps_registry = apps
         self.settings = settings
 
+        self._model_foreign_keys: Dict[Type[Model], List[Tuple[ForeignKey, Optional[Type[Model]], bool]]] = {}
+
     @cached_property
     def model_modules(self) -> Dict[str, Set[Type[Model]]]:
         """ All modules that contain Django models. """
@@ -114,11 +117,47 @@ class DjangoContext:
                 return model_cls
         return None
 
+    def get_model_module_fingerprint(self, module: str) -> Optional[str]:
+        """ Digest of the models state of the module, that plugin generated model attributes depend on. """
+        model_classes = self.model_modules.get(module)
+        if not model_classes:
+            return None
+
+        digest = hashlib.blake2b(digest_size=16)
+        for model_cls in sorted(model_classes, key=lambda cls: cls.__qualname__):
+            digest.update(helpers.get_class_fullname(model_cls).encode())
+            for field in model_cls._meta.get_fields():
+                accessor_name = None
+                if isinstance(field, ForeignObjectRel):
+                    accessor_name = field.get_accessor_name()
+                field_state = (field.name, getattr(field, 'attname', None), accessor_name,
+                               helpers.get_class_fullname(field.__class__),
+                               # GenericForeignKey has no `null`
+                               getattr(field, 'null', None), bool(getattr(field, 'choices', None)),
+                               repr(field.related_model))
+                digest.update(repr(field_state).encode())
+            for manager_name, manager in model_cls._meta.managers_map.items():
+                manager_state = (manager_name, helpers.get_class_fullname(manager.__class__))
+                digest.update(repr(manager_state).encode())
+        return digest.hexdigest()
+
     def get_model_fields(self, model_cls: Type[Model]) -> Iterator[Field]:
         for field in model_cls._meta.get_fields():
             if isinstance(field, Field):
                 yield field
 
+    def get_model_foreign_keys(self, model_cls: Type[Model]) -> List[Tuple[ForeignKey, Optional[Type[Model]], bool]]:
+        """ Foreign keys of the model with related model classes and nullability, computed once per model. """
+        foreign_keys = self._model_foreign_keys.get(model_cls)
+        if foreign_keys is None:
+            foreign_keys = [(field,
+                             self.get_field_related_model_cls(field),
+                             self.get_field_nullability(field, None))
+                            for field in model_cls._meta.get_fields()
+                            if isinstance(field, ForeignKey)]
+            self._model_foreign_keys[model_cls] = foreign_keys
+        return foreign_keys
+
     def get_model_relations(self, model_cls: Type[Model]) -> Iterator[ForeignObjectRel]:
         for field in model_cls._meta.get_fields():
             if isinstance(field, ForeignObjectRel):
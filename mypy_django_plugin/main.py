@@ -1,6 +1,6 @@
 import configparser
 from functools import partial
-from typing import Callable, Dict, List, Optional, Tuple
+from typing import Any, Callable, Dict, List, Optional, Tuple
 
 from django.db.models.fields.related import RelatedField
 from mypy.errors import Errors
@@ -8,6 +8,7 @@ from mypy.nodes import MypyFile, TypeInfo
 from mypy.options import Options
 from mypy.plugin import (
     AttributeContext, ClassDefContext, DynamicClassDefContext, FunctionContext, MethodContext, Plugin,
+    ReportConfigContext,
 )
 from mypy.types import Type as MypyType
 
@@ -166,6 +167,11 @@ class NewSemanalDjangoPlugin(Plugin):
                     deps.add(self._new_dependency(related_model_module))
         return list(deps)
 
+    def report_config_data(self, ctx: ReportConfigContext) -> Any:
+        # plugin generated model attributes are stored in the mypy cache along with the module,
+        # it should be invalidated only if the state of django models of that module has changed
+        return self.django_context.get_model_module_fingerprint(ctx.id)
+
     def get_function_hook(self, fullname: str
                           ) -> Optional[Callable[[FunctionContext], MypyType]]:
         if fullname == 'django.contrib.auth.get_user_model':
@@ -1,11 +1,11 @@
-from typing import Dict, List, Optional, Type, cast
+from typing import Dict, List, Optional, Tuple, Type, cast
 
 from django.db.models.base import Model
 from django.db.models.fields import DateField, DateTimeField
-from django.db.models.fields.related import ForeignKey
 from django.db.models.fields.reverse_related import (
     ManyToManyRel, ManyToOneRel, OneToOneRel,
 )
+from django.db.models.manager import Manager
 from mypy.nodes import ARG_STAR2, Argument, Context, FuncDef, TypeInfo, Var
 from mypy.plugin import ClassDefContext
 from mypy.plugins import common
@@ -17,10 +17,47 @@ from mypy.types import TypeOfAny
 from mypy_django_plugin.django.context import DjangoContext
 from mypy_django_plugin.lib import fullnames, helpers
 from mypy_django_plugin.transformers import fields
-from mypy_django_plugin.transformers.fields import get_field_descriptor_types
+
+_ANY_EXPLICIT = AnyType(TypeOfAny.explicit)
+
+
+def _make_star2_kwargs_argument() -> Argument:
+    # type checker sets the type of argument variable in every generated method, so it cannot be shared
+    return Argument(Var('kwargs', _ANY_EXPLICIT), _ANY_EXPLICIT,
+                    initializer=None, kind=ARG_STAR2)
+
+
+class _SemanalCaches:
+    """
+    Caches of model initializers, valid only for the SemanticAnalyzer (i.e. mypy build) they were created for.
+    Keyed by fullnames, so that they do not grow when mypy daemon reprocesses modules.
+    """
+
+    def __init__(self, api: SemanticAnalyzer) -> None:
+        self.api = api
+        # (field fullname, is_nullable) -> (field TypeInfo, (set_type, get_type))
+        self.field_descriptor_types: Dict[Tuple[str, bool], Tuple[TypeInfo, Tuple[MypyType, MypyType]]] = {}
+        # manager fullname -> (manager TypeInfo, has any parametrized manager as base)
+        self.has_parametrized_manager_base: Dict[str, Tuple[TypeInfo, bool]] = {}
+        # model fullname -> (model TypeInfo, bitmask of initializers already applied to it)
+        self.done_initializers: Dict[str, Tuple[TypeInfo, int]] = {}
+
+
+_semanal_caches: Optional[_SemanalCaches] = None
+
+
+def _get_semanal_caches(api: SemanticAnalyzer) -> _SemanalCaches:
+    global _semanal_caches
+    # reference to the api is kept, so that a new build could never be mistaken for the previous one
+    if _semanal_caches is None or _semanal_caches.api is not api:
+        _semanal_caches = _SemanalCaches(api)
+    return _semanal_caches
 
 
 class ModelClassInitializer:
+    # instantiated for every initializer of every processed model class
+    __slots__ = ('api', 'model_classdef', 'django_context', 'ctx', 'caches', '_self_instance')
+
     api: SemanticAnalyzer
 
     def __init__(self, ctx: ClassDefContext, django_context: DjangoContext):
@@ -28,10 +65,31 @@ class ModelClassInitializer:
         self.model_classdef = ctx.cls
         self.django_context = django_context
         self.ctx = ctx
+        self.caches = _get_semanal_caches(self.api)
+        self._self_instance: Optional[Instance] = None
+
+    @property
+    def self_instance(self) -> Instance:
+        """ Instance of the current model class, shared between all types which are parametrized with it. """
+        if self._self_instance is None:
+            self._self_instance = Instance(self.model_classdef.info, [])
+        return self._self_instance
 
     def lookup_typeinfo(self, fullname: str) -> Optional[TypeInfo]:
         return helpers.lookup_fully_qualified_typeinfo(self.api, fullname)
 
+    def get_field_descriptor_types(self, field_info: TypeInfo, is_nullable: bool) -> Tuple[MypyType, MypyType]:
+        key = (field_info.fullname, is_nullable)
+        cached = self.caches.field_descriptor_types.get(key)
+        if cached is not None and cached[0] is field_info:
+            return cached[1]
+
+        descriptor_types = fields.get_field_descriptor_types(field_info, is_nullable)
+        # private descriptor attributes could be not analyzed yet, do not store fallback Any
+        if not any(isinstance(typ, AnyType) for typ in descriptor_types):
+            self.caches.field_descriptor_types[key] = (field_info, descriptor_types)
+        return descriptor_types
+
     def lookup_typeinfo_or_incomplete_defn_error(self, fullname: str) -> TypeInfo:
         info = self.lookup_typeinfo(fullname)
         if info is None:
@@ -47,12 +105,17 @@ class ModelClassInitializer:
         # type=: type of the variable itself
         var = Var(name=name, type=typ)
         # var.info: type of the object variable is bound to
-        var.info = self.model_classdef.info
-        var._fullname = self.model_classdef.info.fullname + '.' + name
+        info = self.model_classdef.info
+        var.info = info
+        var._fullname = f'{info.fullname}.{name}'
         var.is_initialized_in_class = True
         var.is_inferred = True
         return var
 
+    def has_plugin_generated_node(self, name: str) -> bool:
+        sym = self.model_classdef.info.names.get(name)
+        return sym is not None and sym.plugin_generated
+
     def add_new_node_to_model_class(self, name: str, typ: MypyType) -> None:
         helpers.add_new_sym_for_info(self.model_classdef.info,
                                      name=name,
@@ -86,6 +149,7 @@ class InjectAnyAsBaseForNestedMeta(ModelClassInitializer):
                 pass
     to get around incompatible Meta inner classes for different models.
     """
+    __slots__ = ()
 
     def run(self) -> None:
         meta_node = helpers.get_nested_meta_node_for_current_class(self.model_classdef.info)
@@ -95,6 +159,8 @@ class InjectAnyAsBaseForNestedMeta(ModelClassInitializer):
 
 
 class AddDefaultPrimaryKey(ModelClassInitializer):
+    __slots__ = ()
+
     def run_with_model_cls(self, model_cls: Type[Model]) -> None:
         auto_field = model_cls._meta.auto_field
         if auto_field and not self.model_classdef.info.has_readable_member(auto_field.attname):
@@ -102,52 +168,68 @@ class AddDefaultPrimaryKey(ModelClassInitializer):
             auto_field_fullname = helpers.get_class_fullname(auto_field.__class__)
             auto_field_info = self.lookup_typeinfo_or_incomplete_defn_error(auto_field_fullname)
 
-            set_type, get_type = fields.get_field_descriptor_types(auto_field_info, is_nullable=False)
+            set_type, get_type = self.get_field_descriptor_types(auto_field_info, is_nullable=False)
             self.add_new_node_to_model_class(auto_field.attname, Instance(auto_field_info,
                                                                           [set_type, get_type]))
 
 
 class AddRelatedModelsId(ModelClassInitializer):
+    __slots__ = ()
+
     def run_with_model_cls(self, model_cls: Type[Model]) -> None:
-        for field in model_cls._meta.get_fields():
-            if isinstance(field, ForeignKey):
-                related_model_cls = self.django_context.get_field_related_model_cls(field)
-                if related_model_cls is None:
-                    error_context: Context = self.ctx.cls
-                    field_sym = self.ctx.cls.info.get(field.name)
-                    if field_sym is not None and field_sym.node is not None:
-                        error_context = field_sym.node
-                    self.api.fail(f'Cannot find model {field.related_model!r} '
-                                  f'referenced in field {field.name!r} ',
-                                  ctx=error_context)
-                    self.add_new_node_to_model_class(field.attname,
-                                                     AnyType(TypeOfAny.explicit))
-                    continue
+        api = self.api
+        django_context = self.django_context
+        model_info = self.model_classdef.info
+        # foreign keys to the same model share the type of its primary key field
+        rel_primary_key_infos: Dict[Type[Model], TypeInfo] = {}
+        for field, related_model_cls, is_nullable in django_context.get_model_foreign_keys(model_cls):
+            if related_model_cls is None:
+                error_context: Context = self.model_classdef
+                field_sym = model_info.get(field.name)
+                if field_sym is not None and field_sym.node is not None:
+                    error_context = field_sym.node
+                api.fail(f'Cannot find model {field.related_model!r} '
+                         f'referenced in field {field.name!r} ',
+                         ctx=error_context)
+                self.add_new_node_to_model_class(field.attname, _ANY_EXPLICIT)
+                continue
 
-                if related_model_cls._meta.abstract:
-                    continue
+            if related_model_cls._meta.abstract:
+                continue
 
-                rel_primary_key_field = self.django_context.get_primary_key_field(related_model_cls)
+            if self.has_plugin_generated_node(field.attname):
+                # added on one of the previous iterations
+                continue
+
+            field_info = rel_primary_key_infos.get(related_model_cls)
+            if field_info is None:
+                rel_primary_key_field = django_context.get_primary_key_field(related_model_cls)
                 try:
                     field_info = self.lookup_class_typeinfo_or_incomplete_defn_error(rel_primary_key_field.__class__)
                 except helpers.IncompleteDefnException as exc:
-                    if not self.api.final_iteration:
+                    if not api.final_iteration:
                         raise exc
                     else:
                         continue
+                rel_primary_key_infos[related_model_cls] = field_info
 
-                is_nullable = self.django_context.get_field_nullability(field, None)
-                set_type, get_type = get_field_descriptor_types(field_info, is_nullable)
-                self.add_new_node_to_model_class(field.attname,
-                                                 Instance(field_info, [set_type, get_type]))
+            set_type, get_type = self.get_field_descriptor_types(field_info, is_nullable)
+            self.add_new_node_to_model_class(field.attname,
+                                             Instance(field_info, [set_type, get_type]))
 
 
 class AddManagers(ModelClassInitializer):
+    __slots__ = ()
+
     def has_any_parametrized_manager_as_base(self, info: TypeInfo) -> bool:
-        for base in helpers.iter_bases(info):
-            if self.is_any_parametrized_manager(base):
-                return True
-        return False
+        cached = self.caches.has_parametrized_manager_base.get(info.fullname)
+        if cached is not None and cached[0] is info:
+            return cached[1]
+
+        has_parametrized_base = any(self.is_any_parametrized_manager(base)
+                                    for base in helpers.iter_bases(info))
+        self.caches.has_parametrized_manager_base[info.fullname] = (info, has_parametrized_base)
+        return has_parametrized_base
 
     def is_any_parametrized_manager(self, typ: Instance) -> bool:
         return typ.type.fullname in fullnames.MANAGER_CLASSES and isinstance(typ.args[0], AnyType)
@@ -166,8 +248,7 @@ class AddManagers(ModelClassInitializer):
                 if original_base.type is None:
                     raise helpers.IncompleteDefnException()
 
-                original_base = helpers.reparametrize_instance(original_base,
-                                                               [Instance(self.model_classdef.info, [])])
+                original_base = helpers.reparametrize_instance(original_base, [self.self_instance])
             bases.append(original_base)
 
         new_manager_info = self.add_new_class_for_current_module(name, bases)
@@ -175,7 +256,7 @@ class AddManagers(ModelClassInitializer):
         new_cls_def_context = ClassDefContext(cls=new_manager_info.defn,
                                               reason=self.ctx.reason,
                                               api=self.api)
-        custom_manager_type = Instance(new_manager_info, [Instance(self.model_classdef.info, [])])
+        custom_manager_type = Instance(new_manager_info, [self.self_instance])
 
         for name, sym in base_manager_info.names.items():
             # replace self type with new class, if copying method
@@ -190,20 +271,31 @@ class AddManagers(ModelClassInitializer):
             if isinstance(new_sym.node, Var):
                 new_var = Var(name, type=sym.type)
                 new_var.info = new_manager_info
-                new_var._fullname = new_manager_info.fullname + '.' + name
+                new_var._fullname = f'{new_manager_info.fullname}.{name}'
                 new_sym.node = new_var
             new_manager_info.names[name] = new_sym
 
         return custom_manager_type
 
     def run_with_model_cls(self, model_cls: Type[Model]) -> None:
-        for manager_name, manager in model_cls._meta.managers_map.items():
+        api = self.api
+        model_names = self.model_classdef.info.names
+        managers_map = model_cls._meta.managers_map
+        if len(managers_map) == 1:
+            # only default `objects = Manager()`, no custom manager class to resolve
+            manager_name, manager = next(iter(managers_map.items()))
+            if manager.__class__ is Manager and manager_name not in model_names:
+                manager_info = self.lookup_typeinfo_or_incomplete_defn_error(fullnames.MANAGER_CLASS_FULLNAME)
+                self.add_new_node_to_model_class(manager_name, Instance(manager_info, [self.self_instance]))
+                return
+
+        for manager_name, manager in managers_map.items():
             manager_class_name = manager.__class__.__name__
             manager_fullname = helpers.get_class_fullname(manager.__class__)
             try:
                 manager_info = self.lookup_typeinfo_or_incomplete_defn_error(manager_fullname)
             except helpers.IncompleteDefnException as exc:
-                if not self.api.final_iteration:
+                if not api.final_iteration:
                     raise exc
                 else:
                     base_manager_fullname = helpers.get_class_fullname(manager.__class__.__bases__[0])
@@ -217,8 +309,8 @@ class AddManagers(ModelClassInitializer):
                         continue
                     manager_class_name = real_manager_fullname.rsplit('.', maxsplit=1)[1]
 
-            if manager_name not in self.model_classdef.info.names:
-                manager_type = Instance(manager_info, [Instance(self.model_classdef.info, [])])
+            if manager_name not in model_names:
+                manager_type = Instance(manager_info, [self.self_instance])
                 self.add_new_node_to_model_class(manager_name, manager_type)
             else:
                 # creates new MODELNAME_MANAGERCLASSNAME class that represents manager parametrized with current model
@@ -236,35 +328,53 @@ class AddManagers(ModelClassInitializer):
 
 
 class AddDefaultManagerAttribute(ModelClassInitializer):
+    __slots__ = ()
+
     def run_with_model_cls(self, model_cls: Type[Model]) -> None:
         # add _default_manager
         if '_default_manager' not in self.model_classdef.info.names:
             default_manager_fullname = helpers.get_class_fullname(model_cls._meta.default_manager.__class__)
             default_manager_info = self.lookup_typeinfo_or_incomplete_defn_error(default_manager_fullname)
-            default_manager = Instance(default_manager_info, [Instance(self.model_classdef.info, [])])
+            default_manager = Instance(default_manager_info, [self.self_instance])
             self.add_new_node_to_model_class('_default_manager', default_manager)
 
 
 class AddRelatedManagers(ModelClassInitializer):
+    __slots__ = ()
+
     def run_with_model_cls(self, model_cls: Type[Model]) -> None:
+        api = self.api
+        django_context = self.django_context
+        relations = list(django_context.get_model_relations(model_cls))
+        # reverse relations from the same model share its TypeInfo
+        related_model_infos: Dict[Type[Model], TypeInfo] = {}
+        # resolved once, on the first many-to-one / many-to-many relation
+        related_manager_info: Optional[TypeInfo] = None
         # add related managers
-        for relation in self.django_context.get_model_relations(model_cls):
+        for relation in relations:
             attname = relation.get_accessor_name()
             if attname is None:
                 # no reverse accessor
                 continue
 
-            related_model_cls = self.django_context.get_field_related_model_cls(relation)
+            related_model_cls = django_context.get_field_related_model_cls(relation)
             if related_model_cls is None:
                 continue
 
-            try:
-                related_model_info = self.lookup_class_typeinfo_or_incomplete_defn_error(related_model_cls)
-            except helpers.IncompleteDefnException as exc:
-                if not self.api.final_iteration:
-                    raise exc
-                else:
-                    continue
+            if self.has_plugin_generated_node(attname):
+                # added on one of the previous iterations
+                continue
+
+            related_model_info = related_model_infos.get(related_model_cls)
+            if related_model_info is None:
+                try:
+                    related_model_info = self.lookup_class_typeinfo_or_incomplete_defn_error(related_model_cls)
+                except helpers.IncompleteDefnException as exc:
+                    if not api.final_iteration:
+                        raise exc
+                    else:
+                        continue
+                related_model_infos[related_model_cls] = related_model_info
 
             if isinstance(relation, OneToOneRel):
                 self.add_new_node_to_model_class(attname, Instance(related_model_info, []))
@@ -272,11 +382,13 @@ class AddRelatedManagers(ModelClassInitializer):
 
             if isinstance(relation, (ManyToOneRel, ManyToManyRel)):
                 try:
-                    related_manager_info = self.lookup_typeinfo_or_incomplete_defn_error(fullnames.RELATED_MANAGER_CLASS)  # noqa: E501
+                    if related_manager_info is None:
+                        related_manager_info = self.lookup_typeinfo_or_incomplete_defn_error(
+                            fullnames.RELATED_MANAGER_CLASS)
                     if 'objects' not in related_model_info.names:
                         raise helpers.IncompleteDefnException()
                 except helpers.IncompleteDefnException as exc:
-                    if not self.api.final_iteration:
+                    if not api.final_iteration:
                         raise exc
                     else:
                         continue
@@ -299,62 +411,79 @@ class AddRelatedManagers(ModelClassInitializer):
 
 
 class AddExtraFieldMethods(ModelClassInitializer):
+    __slots__ = ()
+
     def run_with_model_cls(self, model_cls: Type[Model]) -> None:
-        # get_FOO_display for choices
+        str_info = None
         for field in self.django_context.get_model_fields(model_cls):
+            # get_FOO_display for choices
             if field.choices:
-                info = self.lookup_typeinfo_or_incomplete_defn_error('builtins.str')
-                return_type = Instance(info, [])
+                if str_info is None:
+                    str_info = self.lookup_typeinfo_or_incomplete_defn_error('builtins.str')
                 common.add_method(self.ctx,
-                                  name='get_{}_display'.format(field.attname),
+                                  name=f'get_{field.attname}_display',
                                   args=[],
-                                  return_type=return_type)
+                                  return_type=Instance(str_info, []))
 
-        # get_next_by, get_previous_by for Date, DateTime
-        for field in self.django_context.get_model_fields(model_cls):
+            # get_next_by, get_previous_by for Date, DateTime
             if isinstance(field, (DateField, DateTimeField)) and not field.null:
-                return_type = Instance(self.model_classdef.info, [])
+                return_type = self.self_instance
                 common.add_method(self.ctx,
-                                  name='get_next_by_{}'.format(field.attname),
-                                  args=[Argument(Var('kwargs', AnyType(TypeOfAny.explicit)),
-                                                 AnyType(TypeOfAny.explicit),
-                                                 initializer=None,
-                                                 kind=ARG_STAR2)],
+                                  name=f'get_next_by_{field.attname}',
+                                  args=[_make_star2_kwargs_argument()],
                                   return_type=return_type)
                 common.add_method(self.ctx,
-                                  name='get_previous_by_{}'.format(field.attname),
-                                  args=[Argument(Var('kwargs', AnyType(TypeOfAny.explicit)),
-                                                 AnyType(TypeOfAny.explicit),
-                                                 initializer=None,
-                                                 kind=ARG_STAR2)],
+                                  name=f'get_previous_by_{field.attname}',
+                                  args=[_make_star2_kwargs_argument()],
                                   return_type=return_type)
 
 
 class AddMetaOptionsAttribute(ModelClassInitializer):
+    __slots__ = ()
+
     def run_with_model_cls(self, model_cls: Type[Model]) -> None:
         if '_meta' not in self.model_classdef.info.names:
             options_info = self.lookup_typeinfo_or_incomplete_defn_error(fullnames.OPTIONS_CLASS_FULLNAME)
             self.add_new_node_to_model_class('_meta',
-                                             Instance(options_info, [
-                                                 Instance(self.model_classdef.info, [])
-                                             ]))
+                                             Instance(options_info, [self.self_instance]))
+
+
+# order matters, i.e. related managers require 'objects' of related models
+_INITIALIZERS: Tuple[Type[ModelClassInitializer], ...] = (
+    InjectAnyAsBaseForNestedMeta,
+    AddDefaultPrimaryKey,
+    AddRelatedModelsId,
+    AddManagers,
+    AddDefaultManagerAttribute,
+    AddRelatedManagers,
+    AddExtraFieldMethods,
+    AddMetaOptionsAttribute,
+)
 
 
 def process_model_class(ctx: ClassDefContext,
                         django_context: DjangoContext) -> None:
-    initializers = [
-        InjectAnyAsBaseForNestedMeta,
-        AddDefaultPrimaryKey,
-        AddRelatedModelsId,
-        AddManagers,
-        AddDefaultManagerAttribute,
-        AddRelatedManagers,
-        AddExtraFieldMethods,
-        AddMetaOptionsAttribute,
-    ]
-    for initializer_cls in initializers:
+    api = cast(SemanticAnalyzer, ctx.api)
+    # bitmask of initializers, which are already applied to the class, so that
+    # deferred class is not processed from scratch on every next iteration.
+    # Not stored in the metadata, as it's serialized into mypy cache.
+    model_info = ctx.cls.info
+    caches = _get_semanal_caches(api)
+    done_initializers = 0
+    cached = caches.done_initializers.get(model_info.fullname)
+    if cached is not None and cached[0] is model_info:
+        done_initializers = cached[1]
+    for i, initializer_cls in enumerate(_INITIALIZERS):
+        initializer_bit = 1 << i
+        if done_initializers & initializer_bit:
+            continue
         try:
             initializer_cls(ctx, django_context).run()
         except helpers.IncompleteDefnException:
-            if not ctx.api.final_iteration:
-                ctx.api.defer()
+            if not api.final_iteration:
+                api.defer()
+            continue
+        # initializer could have deferred current target by itself (copying methods, etc.), re-run it then
+        if not api.deferred:
+            done_initializers |= initializer_bit
+    caches.done_initializers[model_info.fullname] = (model_info, done_initializers)